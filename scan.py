@@ -1,15 +1,62 @@
-from datetime import datetime
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import enum
+from functools import lru_cache
 import json
+from operator import itemgetter
+import os
+import re
+import time
 from lxml import html
 from markupsafe import escape
 import requests
-from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 from typing import Dict, List, Optional, Tuple
 
 SENTINEL = "<!--- CUT -->"
+SCAN_FILE = "scan.json"
+
+# Results in the previous scan newer than this many seconds are reused rather than
+# rescanned. The default is a bit under a day so that a daily scan refreshes everything.
+CACHE_TTL = int(os.environ.get("SCAN_CACHE_TTL", 20 * 60 * 60))
+
+# Number of sites to scan concurrently. Scanning is network-bound, so this can be
+# tuned to the available bandwidth via the environment.
+MAX_WORKERS = int(os.environ.get("SCAN_MAX_WORKERS", 32))
+
+# Connect and read timeouts, in seconds, for each request made while scanning a site.
+TIMEOUT = (3, 5)
+
+# Shared by all scans so that connections (e.g. across redirects) are kept alive and
+# reused. The pool is sized so that every worker can hold a connection, and transient
+# failures are retried once so that a single hiccup doesn't mark a site as unscannable.
+# Retry-After is ignored so that a server can't stall a worker for as long as it likes,
+# and if the retry also fails the last response is returned and scanned as usual.
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=MAX_WORKERS,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=Retry(
+        total=1,
+        connect=1,
+        read=1,
+        backoff_factor=0.2,
+        status_forcelist=(502, 503, 504),
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    ),
+)
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
+
+# Bounded so that a closing tag split across chunks is always caught by looking back
+# _HEAD_END_MAX_LEN bytes (see _read_head).
+_HEAD_END_RE = re.compile(rb"</head\s{0,8}>", re.IGNORECASE)
+_HEAD_END_MAX_LEN = len(b"</head>") + 8
+_ONION_LOCATION_RE = re.compile(rb"onion-location", re.IGNORECASE)
 
 
 class OnionService(enum.Enum):
@@ -25,43 +72,67 @@ class OnionService(enum.Enum):
 
     @classmethod
     def from_str(cls, url: str):
-        url = urlparse(url)
-
-        # Length of netloc includes .onion, so we have 62 chars for V3, 22 for V2
-        V3_addr_len = 62
-        V2_addr_len = 22
+        # Address lengths exclude .onion: 56 chars for V3, 16 for V2
+        V3_addr_len = 56
+        V2_addr_len = 16
 
-        # urlparse() apparently sometimes parses the onion URL to the netloc OR
-        # the path attributes, so we look at both.
-        if "www" in url.netloc.split(".")[0]:
-            url_without_www = ".".join(url.netloc.split(".")[1:])
-        else:
-            url_without_www = url.netloc
-        if len(url_without_www) == V3_addr_len or len(url.path) == V3_addr_len:
+        # The address is everything between the scheme (if any) and .onion, so we find it
+        # directly rather than parsing the whole URL.
+        end = url.lower().find(".onion")
+        if end == -1:
+            raise ValueError(f"invalid URL: {url}")
+        address = url[url.rfind("/", 0, end) + 1:end]
+        address_len = len(address)
+        if address.startswith("www."):
+            address_len -= 4
+        if address_len == V3_addr_len:
             return cls.V3
-        elif len(url_without_www) == V2_addr_len or len(url.path) == V2_addr_len:
+        elif address_len == V2_addr_len:
             return cls.V2
         else:
-            raise ValueError(f"invalid URL: {url.netloc}")
+            raise ValueError(f"invalid URL: {url}")
+
+
+def _read_head(r: requests.Response) -> bytes:
+    """
+    Read the response body only up to the end of the <head>, where meta tags belong.
+
+    An onion-location meta tag placed in the <body> is therefore not detected.
+    """
+    content = bytearray()
+    for chunk in r.iter_content(chunk_size=8192):
+        # Search from a little before the new chunk in case the closing tag was split.
+        start = max(len(content) - _HEAD_END_MAX_LEN, 0)
+        content += chunk
+        match = _HEAD_END_RE.search(content, start)
+        if match:
+            return bytes(content[: match.end()])
+    return bytes(content)
 
 
 def has_onion_service(url: str) -> Tuple[Optional[bool], Optional[OnionService], str]:
     try:
-        r = requests.get("https://" + url, timeout=5)
-        onion_url = r.headers["Onion-Location"]
+        # Stream the response so that the body is only downloaded when the header is
+        # missing and we need to look for a meta tag instead.
+        with _SESSION.get("https://" + url, timeout=TIMEOUT, stream=True) as r:
+            # The headers are a case-insensitive dict, so this is a single lookup.
+            onion_url = r.headers.get("Onion-Location")
+            if onion_url is None:
+                # Even if the header is missing, the onion URL could be in a meta tag.
+                # Most pages don't mention onion-location at all, in which case there's
+                # no need to parse the HTML.
+                head = _read_head(r)
+                if not _ONION_LOCATION_RE.search(head):
+                    return False, None, None
+                tree = html.fromstring(head)
+                matching_meta_tags = tree.xpath('//meta[@http-equiv="onion-location"]/@content')
+                if not matching_meta_tags:
+                    return False, None, None
+                # If we see more than one onion-location meta tag, we raise AssertionError:
+                assert len(matching_meta_tags) == 1
+                onion_url = matching_meta_tags[0]
         version = OnionService.from_str(onion_url)
         return True, version, onion_url
-    except KeyError:
-        # Even if the header is missing, the onion URL could be in a meta tag.
-        tree = html.fromstring(r.content)
-        matching_meta_tags = tree.xpath('//meta[@http-equiv="onion-location"]/@content')
-        if matching_meta_tags:
-            # If we see more than one onion-location meta tag, we raise AssertionError:
-            assert len(matching_meta_tags) == 1
-            version = OnionService.from_str(matching_meta_tags[0])
-            return True, version, matching_meta_tags[0]
-        else:
-            return False, None, None
     except Exception as e:
         # Unexpected exceptions we just print the exception for later inspection
         # (if we raise other sites will fail to scan) and return that the site is unscannable.
@@ -69,82 +140,135 @@ def has_onion_service(url: str) -> Tuple[Optional[bool], Optional[OnionService],
         return None, None, None
 
 
-def update_sites(sites: List[str]) -> Dict:
+def load_scan_results(path: str = SCAN_FILE) -> Dict:
+    """Load the results of the previous scan, if there is one"""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def update_sites(sites: List[str], force: bool = False) -> Dict:
+    now = time.time()
+    previous_results = {} if force else load_scan_results()
+
+    # Reuse recent results from the previous scan, and only scan sites that are new,
+    # out of date, or could not be scanned last time.
     results = {}
+    stale_sites = []
     for site in sites:
-        has_onion, version, onion_url = has_onion_service(site)
-        site = site.lstrip('www.')
-        results.update(
-            {
-                site: {
-                    "has_onion": has_onion,
-                    "version": getattr(version, "value", None),
-                    "onion_url": escape(onion_url),
+        previous = previous_results.get(site.lstrip('www.'))
+        if (
+            previous is None
+            or previous["has_onion"] is None
+            or now - previous.get("scanned_at", 0) > CACHE_TTL
+        ):
+            stale_sites.append(site)
+        else:
+            results[site.lstrip('www.')] = previous
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(has_onion_service, site): site for site in stale_sites}
+        for future in as_completed(futures):
+            has_onion, version, onion_url = future.result()
+            site = futures[future].lstrip('www.')
+            results.update(
+                {
+                    site: {
+                        "has_onion": has_onion,
+                        "version": getattr(version, "value", None),
+                        "onion_url": escape(onion_url) if onion_url else None,
+                        "scanned_at": now,
+                    }
                 }
-            }
-        )
+            )
 
     # Sort results by version/status (v3 at top, then v2, then no onion or unknown status),
     # then alphabetical order.
-    results = dict(
-        sorted(
-            results.items(),
-            key=lambda x: (
-                float("inf") if x[1]["version"] is None else -1 * x[1]["version"],
-                x[0].lower(),
-            ),
-        )
-    )
+    # Sort keys are built once per site; versions are negated so that no version (0)
+    # sorts last.
+    ordered = [
+        ((-1 * (data["version"] or 0), site.lower()), site, data)
+        for site, data in results.items()
+    ]
+    ordered.sort(key=itemgetter(0))
+    results = {site: data for _, site, data in ordered}
 
     return results
 
 
+V3_ONION = '<li class="list-group-item list-group-item-success">③ &nbsp;&nbsp;'
+V2_ONION = '<li class="list-group-item list-group-item-warning">② &nbsp;&nbsp;'
+SVG_NO_ONION = '<svg width="1em" height="1em" viewBox="0 0 16 16" class="bi bi-x" fill="currentColor" xmlns="http://www.w3.org/2000/svg"><path fill-rule="evenodd" d="M11.854 4.146a.5.5 0 0 1 0 .708l-7 7a.5.5 0 0 1-.708-.708l7-7a.5.5 0 0 1 .708 0z"/><path fill-rule="evenodd" d="M4.146 4.146a.5.5 0 0 0 0 .708l7 7a.5.5 0 0 0 .708-.708l-7-7a.5.5 0 0 0-.708 0z"/></svg>'
+NO_ONION = '<li class="list-group-item list-group-item-danger">{}&nbsp;&nbsp;'.format(SVG_NO_ONION)
+SVG_NO_DATA = '<svg width="1em" height="1em" viewBox="0 0 16 16" class="bi bi-cloud-slash" fill="currentColor" xmlns="http://www.w3.org/2000/svg"><path fill-rule="evenodd" d="M3.112 5.112a3.125 3.125 0 0 0-.17.613C1.266 6.095 0 7.555 0 9.318 0 11.366 1.708 13 3.781 13H11l-1-1H3.781C2.231 12 1 10.785 1 9.318c0-1.365 1.064-2.513 2.46-2.666l.446-.05v-.447c0-.075.006-.152.018-.231l-.812-.812zm2.55-1.45l-.725-.725A5.512 5.512 0 0 1 8 2c2.69 0 4.923 2 5.166 4.579C14.758 6.804 16 8.137 16 9.773a3.2 3.2 0 0 1-1.516 2.711l-.733-.733C14.498 11.378 15 10.626 15 9.773c0-1.216-1.02-2.228-2.313-2.228h-.5v-.5C12.188 4.825 10.328 3 8 3c-.875 0-1.678.26-2.339.661zm7.984 10.692l-12-12 .708-.708 12 12-.707.707z"/></svg>'
+NO_DATA = '<li class="list-group-item list-group-item-secondary"> {}&nbsp;&nbsp;'.format(SVG_NO_DATA)
+TERMINATOR = '</li>'
+
+# Rendered once so that each row of the site list only needs the site link itself
+# filled in; keyed by (has_onion, version) with NO_DATA for anything else.
+ROW_PREFIXES = {
+    (True, 3): V3_ONION.encode(),
+    (True, 2): V2_ONION.encode(),
+    (False, None): NO_ONION.encode(),
+}
+NO_DATA_PREFIX = NO_DATA.encode()
+TERMINATOR_BYTES = TERMINATOR.encode() + b"\n"
+
+
+@lru_cache(maxsize=4096)
+def _render_link(site_netloc: str) -> bytes:
+    """Render the link to a site in the site list"""
+    return f'<a href="http://{site_netloc}/">{site_netloc}</a>'.encode()
+
+
 def regenerate_site(scan_data: Dict) -> None:
     """Regenerate static site based on latest scan"""
-    V3_ONION = '<li class="list-group-item list-group-item-success">③ &nbsp;&nbsp;'
-    V2_ONION = '<li class="list-group-item list-group-item-warning">② &nbsp;&nbsp;'
-    SVG_NO_ONION = '<svg width="1em" height="1em" viewBox="0 0 16 16" class="bi bi-x" fill="currentColor" xmlns="http://www.w3.org/2000/svg"><path fill-rule="evenodd" d="M11.854 4.146a.5.5 0 0 1 0 .708l-7 7a.5.5 0 0 1-.708-.708l7-7a.5.5 0 0 1 .708 0z"/><path fill-rule="evenodd" d="M4.146 4.146a.5.5 0 0 0 0 .708l7 7a.5.5 0 0 0 .708-.708l-7-7a.5.5 0 0 0-.708 0z"/></svg>'
-    NO_ONION = '<li class="list-group-item list-group-item-danger">{}&nbsp;&nbsp;'.format(SVG_NO_ONION)
-    SVG_NO_DATA = '<svg width="1em" height="1em" viewBox="0 0 16 16" class="bi bi-cloud-slash" fill="currentColor" xmlns="http://www.w3.org/2000/svg"><path fill-rule="evenodd" d="M3.112 5.112a3.125 3.125 0 0 0-.17.613C1.266 6.095 0 7.555 0 9.318 0 11.366 1.708 13 3.781 13H11l-1-1H3.781C2.231 12 1 10.785 1 9.318c0-1.365 1.064-2.513 2.46-2.666l.446-.05v-.447c0-.075.006-.152.018-.231l-.812-.812zm2.55-1.45l-.725-.725A5.512 5.512 0 0 1 8 2c2.69 0 4.923 2 5.166 4.579C14.758 6.804 16 8.137 16 9.773a3.2 3.2 0 0 1-1.516 2.711l-.733-.733C14.498 11.378 15 10.626 15 9.773c0-1.216-1.02-2.228-2.313-2.228h-.5v-.5C12.188 4.825 10.328 3 8 3c-.875 0-1.678.26-2.339.661zm7.984 10.692l-12-12 .708-.708 12 12-.707.707z"/></svg>'
-    NO_DATA = '<li class="list-group-item list-group-item-secondary"> {}&nbsp;&nbsp;'.format(SVG_NO_DATA)
-    TERMINATOR = '</li>'
-
-    with open("docs/index.html", "r") as f:
+    with open("docs/index.html", "rb") as f:
         site_before = f.read()
 
-    prefix, _, postfix = site_before.split(SENTINEL)
-    site_after = prefix + "\n" + SENTINEL + "\n"
+    # Everything up to the end of the first sentinel and from the start of the second
+    # one is kept as is; only the section between them is rebuilt.
+    sentinel = SENTINEL.encode()
+    start = site_before.find(sentinel) + len(sentinel)
+    end = site_before.find(sentinel, start)
+    if start < len(sentinel) or end == -1:
+        raise ValueError(f"docs/index.html must contain two {SENTINEL} markers")
 
+    # The page is collected as a list of pieces and joined once at the end, so nothing
+    # is copied more than once.
+    parts = [site_before[:start], b"\n"]
     for site_netloc, site_data in scan_data.items():
-        site_link = f'<a href="http://{site_netloc}/">{site_netloc}</a>'
-        if site_data["has_onion"] and site_data["version"] == 3:
-            site_after += V3_ONION + site_link + TERMINATOR + "\n"
-        elif site_data["has_onion"] and site_data["version"] == 2:
-            site_after += V2_ONION + site_link + TERMINATOR + "\n"
-        elif site_data["has_onion"] is False:
-            site_after += NO_ONION + site_link + TERMINATOR + "\n"
-        else:
-            site_after += NO_DATA + site_link + TERMINATOR + "\n"
+        parts.append(ROW_PREFIXES.get((site_data["has_onion"], site_data["version"]), NO_DATA_PREFIX))
+        parts.extend((_render_link(site_netloc), TERMINATOR_BYTES))
 
-    now = datetime.now()
     last_updated_timestamp = (
         '<li class="list-last-updated">Last updated: {}</li>'.format(
-            now.strftime("%m/%d/%Y, %H:%M:%S")
+            time.strftime("%m/%d/%Y, %H:%M:%S")
         )
     )
-    site_after += last_updated_timestamp + "\n"
+    parts.extend((last_updated_timestamp.encode(), b"\n\n", site_before[end:]))
 
-    site_after += "\n" + SENTINEL + "\n" + postfix
-
-    with open("docs/index.html", "w") as f:
-        f.write(site_after)
+    # Write to a temporary file and move it into place, so that the page is never seen
+    # (or left behind after a crash) half-written.
+    with open("docs/index.html.tmp", "wb") as f:
+        f.write(b"".join(parts))
+    os.replace("docs/index.html.tmp", "docs/index.html")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan watched sites and rebuild the site")
+    parser.add_argument(
+        "--force", action="store_true", help="rescan all sites, ignoring the previous scan"
+    )
+    args = parser.parse_args()
+
     with open("watched.txt", "r") as f:
-        sites = f.read().splitlines()
-    results = update_sites(sites)
+        # Skip blank lines, comments and duplicates so that no site is scanned twice.
+        sites = sorted({s for s in (line.strip() for line in f) if s and not s.startswith("#")})
+    results = update_sites(sites, force=args.force)
     print(results)
-    with open("scan.json", "w") as f:
-        f.write(json.dumps(results))
+    with open(SCAN_FILE, "w") as f:
+        json.dump(results, f, separators=(",", ":"))
     regenerate_site(results)